@@ -1,27 +1,48 @@
 import numpy as np
+import copy
 
 from tqdm import tqdm
 import shutil
 import random
+from concurrent.futures import ThreadPoolExecutor
 
 import logging
 
 import torch
 from torch import nn
 from torch.backends import cudnn
-from torch.autograd import Variable
+from torch.cuda.amp import GradScaler
 import torchvision.utils as vutils
 
 from graphs.models.generator import Generator
 from graphs.models.discriminator import Discriminator
-from graphs.losses.loss import BinaryCrossEntropy
+from graphs.losses.loss import BinaryCrossEntropyWithLogits
 from datasets.celebA import CelebADataLoader
+from datasets.prefetcher import CUDAPrefetcher
 
 from tensorboardX import SummaryWriter
 from utils.metrics import AverageMeter, AverageMeterList, evaluate
 from utils.misc import print_cuda_statistics
 
 cudnn.benchmark = True
+# allow TF32 tensor core kernels for convolutions and matmuls on Ampere and newer GPUs
+cudnn.allow_tf32 = True
+torch.backends.cuda.matmul.allow_tf32 = True
+
+
+def cpu_copy(obj):
+    """
+    Copy every tensor of a (nested) checkpoint state to the CPU, so it can be serialized while training goes on
+    :param obj: a tensor or a dict / list / tuple possibly containing tensors
+    :return: the same structure with the tensors copied to the CPU
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: cpu_copy(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(value) for value in obj)
+    return obj
 
 
 class DCGANAgent:
@@ -40,18 +61,14 @@ class DCGANAgent:
         self.batch_size = self.config.batch_size
 
         # define loss
-        self.loss = BinaryCrossEntropy()
-
-        # define optimizers for both generator and discriminator
-        self.optimG = torch.optim.Adam(self.netG.parameters(), lr=self.config.learning_rate, betas=(self.config.beta1, self.config.beta2))
-        self.optimD = torch.optim.Adam(self.netD.parameters(), lr=self.config.learning_rate, betas=(self.config.beta1, self.config.beta2))
+        # fused sigmoid + BCE on D's logits, numerically stable and autocast-safe
+        self.loss = BinaryCrossEntropyWithLogits()
 
         # initialize counter
         self.current_epoch = 0
         self.current_iteration = 0
         self.best_valid_mean_iou = 0
 
-        self.fixed_noise = Variable(torch.randn(self.batch_size, self.config.g_input_size, 1, 1))
         self.real_label = 1
         self.fake_label = 0
 
@@ -74,19 +91,72 @@ class DCGANAgent:
             torch.cuda.manual_seed_all(self.manual_seed)
             print_cuda_statistics()
             torch.cuda.set_device(self.config.gpu_device)
-            self.fixed_noise = self.fixed_noise.cuda(async=self.config.async_loading)
             self.device = torch.device("cuda")
 
         else:
             self.logger.info("Program will run on *****CPU***** ")
             self.device = torch.device("cpu")
 
-        self.netG = self.netG.to(self.device)
-        self.netD = self.netD.to(self.device)
+        # mixed precision: autocast + a single grad scaler shared by G and D (no-ops on CPU)
+        self.amp = self.cuda and self.config.amp
+        self.scaler = GradScaler(enabled=self.amp)
+
+        # noise is sampled directly on the device by its own RNG, no host to device copy
+        self.fixed_noise = torch.randn(self.batch_size, self.config.g_input_size, 1, 1, device=self.device)
+
+        # constant real / fake label tensors and a persistent noise buffer refilled in place every iteration
+        self._y_real = torch.full((self.batch_size,), self.real_label, dtype=torch.float, device=self.device)
+        self._y_fake = torch.full((self.batch_size,), self.fake_label, dtype=torch.float, device=self.device)
+        self._fake_noise = torch.empty(self.batch_size, self.config.g_input_size, 1, 1, device=self.device)
+        # running sums of [loss_D, loss_G, D(x), D(G(z))] stay on the device and are read back once per log interval
+        self._running_stats = torch.zeros(4, device=self.device)
+
+        # replay the whole training step as a CUDA graph, captured on the first full size batch
+        self.use_cuda_graph = self.cuda and self.config.cuda_graph
+        self.step_graph = None
+        self._static_x = None
+
+        # both networks are fully convolutional, NHWC lets cudnn pick its tensor core kernels
+        self.netG = self.netG.to(self.device, memory_format=torch.channels_last)
+        self.netD = self.netD.to(self.device, memory_format=torch.channels_last)
         self.loss = self.loss.to(self.device)
+
+        # define optimizers for both generator and discriminator, after the models are on their device
+        # since the fused Adam kernels need CUDA parameters
+        adam_kwargs = dict(lr=self.config.learning_rate, betas=(self.config.beta1, self.config.beta2),
+                           capturable=self.use_cuda_graph)
+        try:
+            self.optimG = torch.optim.Adam(self.netG.parameters(), fused=self.cuda, **adam_kwargs)
+            self.optimD = torch.optim.Adam(self.netD.parameters(), fused=self.cuda, **adam_kwargs)
+        except TypeError:
+            # PyTorch < 1.13 has no fused Adam, use the multi-tensor implementation instead. Its GradScaler.step
+            # syncs with the host, which can't be captured, so the training step is not run as a CUDA graph
+            self.use_cuda_graph = False
+            adam_kwargs['capturable'] = False
+            self.optimG = torch.optim.Adam(self.netG.parameters(), foreach=self.cuda, **adam_kwargs)
+            self.optimD = torch.optim.Adam(self.netD.parameters(), foreach=self.cuda, **adam_kwargs)
+
+        # fuse conv + batchnorm + activation with TorchInductor; compiling the modules in place keeps
+        # their state_dict keys unchanged for checkpointing. The default mode is used rather than
+        # reduce-overhead, whose CUDA graphs would overwrite D(x) when D is run again on G(z)
+        if self.config.compile:
+            if hasattr(nn.Module, 'compile'):
+                # the checkpointed G forward relies on eager recomputation (its context_fn keeps BatchNorm
+                # from updating the running stats twice), which a compiled graph would not honour
+                if self.config.g_checkpoint:
+                    self.logger.info("WARNING: g_checkpoint is enabled, running the generator eagerly instead of compiling it")
+                else:
+                    self.netG.compile(fullgraph=True)
+                self.netD.compile(fullgraph=True)
+            else:
+                self.logger.info("WARNING: torch.compile needs PyTorch 2.2 or newer, running the models eagerly")
         # Model Loading from the latest checkpoint if not found start from scratch.
         self.load_checkpoint(self.config.checkpoint_file)
 
+        # a single worker writes the checkpoints in the background, one at a time
+        self.checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+        self.checkpoint_future = None
+
         # Summary Writer
         self.summary_writer = SummaryWriter(log_dir=self.config.summary_dir, comment='DCGAN')
 
@@ -94,15 +164,16 @@ class DCGANAgent:
         filename = self.config.checkpoint_dir + file_name
         try:
             self.logger.info("Loading checkpoint '{}'".format(filename))
-            checkpoint = torch.load(filename)
+            # load on the CPU, load_state_dict copies into the parameters already placed on the device
+            checkpoint = torch.load(filename, map_location='cpu')
 
             self.current_epoch = checkpoint['epoch']
             self.current_iteration = checkpoint['iteration']
             self.netG.load_state_dict(checkpoint['G_state_dict'])
-            self.optimG.load_state_dict(checkpoint['G_optimizer'])
+            self.load_optimizer_state(self.optimG, checkpoint['G_optimizer'])
             self.netD.load_state_dict(checkpoint['D_state_dict'])
-            self.optimD.load_state_dict(checkpoint['D_optimizer'])
-            self.fixed_noise = checkpoint['fixed_noise']
+            self.load_optimizer_state(self.optimD, checkpoint['D_optimizer'])
+            self.fixed_noise = checkpoint['fixed_noise'].to(self.device)
             self.manual_seed = checkpoint['manual_seed']
 
             self.logger.info("Checkpoint loaded successfully from '{}' at (epoch {}) at (iteration {})\n"
@@ -111,6 +182,30 @@ class DCGANAgent:
             self.logger.info("No checkpoint exists from '{}'. Skipping...".format(self.config.checkpoint_dir))
             self.logger.info("**First time to train**")
 
+    @staticmethod
+    def load_optimizer_state(optimizer, state_dict):
+        """
+        Load an optimizer state but keep the implementation this run built the optimizer with:
+        load_state_dict would take the fused / capturable / foreach flags of the run that saved it,
+        e.g. fused Adam on CPU parameters or unfused Adam under a CUDA graph
+        :param optimizer: the optimizer to load into
+        :param state_dict: the saved optimizer.state_dict(), with its tensors on the CPU
+        :return:
+        """
+        built_flags = [{key: group[key] for key in ('fused', 'capturable', 'foreach') if key in group}
+                       for group in optimizer.param_groups]
+        optimizer.load_state_dict(state_dict)
+
+        for group, flags in zip(optimizer.param_groups, built_flags):
+            group.update(flags)
+            # fused and capturable Adam keep their step counts on the parameters' device, the others on the CPU
+            on_device = group.get('fused') or group.get('capturable')
+            for param in group['params']:
+                state = optimizer.state.get(param, {})
+                if 'step' in state:
+                    state['step'] = torch.as_tensor(state['step'], dtype=torch.float32,
+                                                    device=param.device if on_device else 'cpu')
+
     def save_checkpoint(self, file_name="checkpoint.pth.tar", is_best = 0):
         state = {
             'epoch': self.current_epoch,
@@ -122,6 +217,21 @@ class DCGANAgent:
             'fixed_noise': self.fixed_noise,
             'manual_seed': self.manual_seed
         }
+        # wait for the previous write first: its errors surface here and at most one snapshot is pending
+        if self.checkpoint_future is not None:
+            self.checkpoint_future.result()
+        # snapshot the state on the CPU now, writing it to disk is overlapped with the next epoch
+        state = cpu_copy(state)
+        self.checkpoint_future = self.checkpoint_executor.submit(self.write_checkpoint, state, file_name, is_best)
+
+    def write_checkpoint(self, state, file_name, is_best):
+        """
+        Write a checkpoint state to disk, runs on the checkpoint thread
+        :param state: the checkpoint state with all its tensors on the CPU
+        :param file_name: name of the checkpoint file in the checkpoint dir
+        :param is_best: also copy it to 'model_best.pth.tar'
+        :return:
+        """
         # Save the state
         torch.save(state, self.config.checkpoint_dir + file_name)
         # If it is the best copy it to another file 'model_best.pth.tar'
@@ -147,72 +257,43 @@ class DCGANAgent:
             self.save_checkpoint()
 
     def train_one_epoch(self):
-        # initialize tqdm batch
-        tqdm_batch = tqdm(self.dataloader.loader, total=self.dataloader.num_iterations, desc="epoch-{}-".format(self.current_epoch))
+        # overlap the host to device copy of the next batch with the current step
+        if self.cuda and self.config.async_loading:
+            loader = CUDAPrefetcher(self.dataloader.loader)
+        else:
+            loader = self.dataloader.loader
+        # initialize tqdm batch, redrawn at most once a second and every 50 iterations to keep the loop light
+        tqdm_batch = tqdm(loader, total=self.dataloader.num_iterations, desc="epoch-{}-".format(self.current_epoch),
+                          mininterval=1.0, miniters=50)
 
         self.netG.train()
         self.netD.train()
 
         epoch_lossG = AverageMeter()
         epoch_lossD = AverageMeter()
-
+        running_count = 0
 
         for curr_it, x in enumerate(tqdm_batch):
-            #y = torch.full((self.batch_size,), self.real_label)
             x = x[0]
-            y = torch.randn(x.size(0), )
-            fake_noise = torch.randn(x.size(0), self.config.g_input_size, 1, 1)
-
-            if self.cuda:
-                x = x.cuda(async=self.config.async_loading)
-                y = y.cuda(async=self.config.async_loading)
-                fake_noise = fake_noise.cuda(async=self.config.async_loading)
-
-            x = Variable(x)
-            y = Variable(y)
-            fake_noise = Variable(fake_noise)
-            ####################
-            # Update D network: maximize log(D(x)) + log(1 - D(G(z)))
-            # train with real
-            self.netD.zero_grad()
-            D_real_out = self.netD(x)
-            y.fill_(self.real_label)
-            loss_D_real = self.loss(D_real_out, y)
-            loss_D_real.backward()
-            #D_mean_real_out = D_real_out.mean().item()
-
-            # train with fake
-            G_fake_out = self.netG(fake_noise)
-            y.fill_(self.fake_label)
-
-            D_fake_out = self.netD(G_fake_out.detach())
-
-            loss_D_fake = self.loss(D_fake_out, y)
-            loss_D_fake.backward()
-            #D_mean_fake_out = D_fake_out.mean().item()
-
-            loss_D = loss_D_fake + loss_D_real
-            self.optimD.step()
-
-            ####################
-            # Update G network: maximize log(D(G(z)))
-            self.netG.zero_grad()
-            y.fill_(self.real_label)
-            D_out = self.netD(G_fake_out)
-            loss_G = self.loss(D_out, y)
-            loss_G.backward()
-
-            #D_G_mean_out = D_out.mean().item()
-
-            self.optimG.step()
-
-            epoch_lossD.update(loss_D.item())
-            epoch_lossG.update(loss_G.item())
+            if self.use_cuda_graph and x.size(0) == self.batch_size:
+                if self.step_graph is None:
+                    self.capture_train_step(x)
+                # copy the batch into the static input of the captured step and replay it
+                self._static_x.copy_(x, non_blocking=True)
+                self.step_graph.replay()
+            else:
+                # the last batch of an epoch may be smaller than batch_size
+                batch_size = x.size(0)
+                # no-op when the prefetcher already moved the batch to the device
+                x = x.to(self.device, non_blocking=True).contiguous(memory_format=torch.channels_last)
+                self.train_step(x, self._fake_noise[:batch_size], self._y_real[:batch_size], self._y_fake[:batch_size])
+            running_count += 1
 
             self.current_iteration += 1
 
-            self.summary_writer.add_scalar("epoch/Generator_loss", epoch_lossG.val, self.current_iteration)
-            self.summary_writer.add_scalar("epoch/Discriminator_loss", epoch_lossD.val, self.current_iteration)
+            if running_count == self.config.log_interval:
+                self.log_running_stats(running_count, epoch_lossD, epoch_lossG)
+                running_count = 0
 
             #if curr_it % 1000 ==  0:
                 #self.summary_writer.add_image("train/Real_Image", x, self.current_iteration)
@@ -226,10 +307,18 @@ class DCGANAgent:
             #self.summary_writer.add_scalar("epoch/Discriminator_loss", epoch_lossD.val, self.current_iteration)
 
             #if curr_it % 1000 ==  0:
+        if running_count:
+            self.log_running_stats(running_count, epoch_lossD, epoch_lossG)
+
         #self.summary_writer.add_image("train/Real_Image", x, self.current_iteration)
-        gen_out = self.netG(self.fixed_noise)
-        out_img = self.dataloader.plot_samples_per_epoch(gen_out.data, self.current_iteration)
-        self.summary_writer.add_image('train/generated_image', out_img, self.current_iteration)
+        # the sample forward skips autograd, uses the BatchNorm running stats and runs in the training dtype,
+        # only the 16 samples of the 4x4 grid are generated and encoded. The next epoch puts G back in train mode
+        self.netG.eval()
+        with torch.no_grad(), self.autocast():
+            gen_out = self.netG(self.fixed_noise[:16])
+        out_img = self.dataloader.plot_samples_per_epoch(gen_out.float(), self.current_iteration)
+        # the saved grid is read back as an HWC array, tensorboardX 2.x defaults to CHW
+        self.summary_writer.add_image('train/generated_image', out_img, self.current_iteration, dataformats='HWC')
 
         tqdm_batch.close()
         #self.summary_writer.add_scalar("epoch/Generator_loss", epoch_lossG.val, self.current_iteration)
@@ -238,6 +327,137 @@ class DCGANAgent:
         self.logger.info("Training at epoch-" + str(self.current_epoch) + " | " + "Discriminator loss: " + str(
             epoch_lossD.val) + " - Generator Loss-: " + str(epoch_lossG.val))
 
+    def train_step(self, x, fake_noise, y_real, y_fake):
+        """
+        One update of D and G on a batch of real images, the step's [loss_D, loss_G, D(x), D(G(z))]
+        are added to the device side running stats.
+        G runs once and D twice (on x and on G(z)), the fake logits are shared by both updates
+        :param x: batch of real images on the device
+        :param fake_noise: noise buffer of the same batch size, resampled in place
+        :param y_real: real labels of the same batch size
+        :param y_fake: fake labels of the same batch size
+        :return:
+        """
+        fake_noise.normal_(0, 1)
+
+        ####################
+        # Update D network: maximize log(D(x)) + log(1 - D(G(z)))
+        # train with real
+        self.netD.zero_grad(set_to_none=True)
+        self.netG.zero_grad(set_to_none=True)
+        with self.autocast():
+            D_real_out = self.netD(x)
+            loss_D_real = self.loss(D_real_out, y_real)
+        self.scaler.scale(loss_D_real).backward()
+
+        # train with fake, a single D forward on G(z) serves both the D and the G update
+        with self.autocast():
+            G_fake_out = self.netG(fake_noise)
+            D_fake_out = self.netD(G_fake_out)
+            loss_D_fake = self.loss(D_fake_out, y_fake)
+            loss_G = self.loss(D_fake_out, y_real)
+
+        # accumulate into D only and keep the graph alive for the G backward below
+        self.scaler.scale(loss_D_fake).backward(inputs=list(self.netD.parameters()), retain_graph=True)
+
+        loss_D = loss_D_fake + loss_D_real
+
+        ####################
+        # Update G network: maximize log(D(G(z)))
+        self.scaler.scale(loss_G).backward(inputs=list(self.netG.parameters()))
+
+        # D is stepped only after the G backward, which still needs the pre-update D weights
+        self.scaler.step(self.optimD)
+        self.scaler.step(self.optimG)
+        # one scale update per iteration, after both optimizers stepped
+        self.scaler.update()
+
+        self._running_stats += torch.stack([loss_D.detach(), loss_G.detach(),
+                                            torch.sigmoid(D_real_out.detach().float()).mean(),
+                                            torch.sigmoid(D_fake_out.detach().float()).mean()])
+
+    def capture_train_step(self, x):
+        """
+        Capture train_step on full size batches into a CUDA graph, replayed with only the real batch copied in.
+        The capture is preceded by a few warm-up steps on a side stream, whose updates are rolled back afterwards
+        :param x: a full size batch of real images, used to warm up
+        :return:
+        """
+        self._static_x = x.to(self.device).contiguous(memory_format=torch.channels_last)
+        step_args = (self._static_x, self._fake_noise, self._y_real, self._y_fake)
+
+        # snapshot everything a training step updates, so the warm-up leaves no trace on training
+        netG_state = copy.deepcopy(self.netG.state_dict())
+        netD_state = copy.deepcopy(self.netD.state_dict())
+        optimG_state = copy.deepcopy(self.optimG.state_dict())
+        optimD_state = copy.deepcopy(self.optimD.state_dict())
+        scaler_state = self.scaler.state_dict()
+
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream):
+            for _ in range(3):
+                self.train_step(*step_args)
+        torch.cuda.current_stream().wait_stream(side_stream)
+
+        self.netG.load_state_dict(netG_state)
+        self.netD.load_state_dict(netD_state)
+        self.restore_optimizer_state(self.optimG, optimG_state)
+        self.restore_optimizer_state(self.optimD, optimD_state)
+        if self.scaler.is_enabled():
+            self.scaler.load_state_dict(scaler_state)
+        # the warm-up steps are not counted in the logged stats
+        self._running_stats.zero_()
+
+        self.step_graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.step_graph):
+            self.train_step(*step_args)
+
+    @staticmethod
+    def restore_optimizer_state(optimizer, state_dict):
+        """
+        Restore an optimizer state in place, so its tensors stay the ones a CUDA graph captures.
+        Parameters without a state in state_dict get the zero state Adam starts from
+        :param optimizer: the optimizer to restore
+        :param state_dict: a copy of an earlier optimizer.state_dict()
+        :return:
+        """
+        saved_state = state_dict['state']
+        params = [param for group in optimizer.param_groups for param in group['params']]
+        for index, param in enumerate(params):
+            for key, value in optimizer.state[param].items():
+                if index in saved_state:
+                    value.copy_(saved_state[index][key])
+                else:
+                    value.zero_()
+
+    def autocast(self):
+        """
+        Autocast region of the forward passes, its weight cast cache can't be used while capturing a CUDA graph
+        :return: the autocast context manager
+        """
+        return torch.autocast(device_type='cuda', dtype=torch.float16, enabled=self.amp,
+                              cache_enabled=not self.use_cuda_graph)
+
+    def log_running_stats(self, count, epoch_lossD, epoch_lossG):
+        """
+        Read the running stats back from the device in a single sync, log them and reset them
+        :param count: number of iterations accumulated in the running stats
+        :param epoch_lossD: epoch meter of the discriminator loss
+        :param epoch_lossG: epoch meter of the generator loss
+        :return:
+        """
+        loss_D, loss_G, D_real_mean, D_fake_mean = [stat / count for stat in self._running_stats.tolist()]
+        # in place, the captured training step keeps accumulating into the same tensor
+        self._running_stats.zero_()
+
+        epoch_lossD.update(loss_D, count)
+        epoch_lossG.update(loss_G, count)
+
+        self.summary_writer.add_scalar("epoch/Generator_loss", epoch_lossG.val, self.current_iteration)
+        self.summary_writer.add_scalar("epoch/Discriminator_loss", epoch_lossD.val, self.current_iteration)
+        self.summary_writer.add_scalar("epoch/D_real_mean", D_real_mean, self.current_iteration)
+        self.summary_writer.add_scalar("epoch/D_fake_mean", D_fake_mean, self.current_iteration)
 
     def validate(self):
         pass
@@ -249,6 +469,9 @@ class DCGANAgent:
         """
         self.logger.info("Please wait while finalizing the operation.. Thank you")
         self.save_checkpoint()
+        # wait for the last checkpoint write, re-raising its error if any
+        self.checkpoint_future.result()
+        self.checkpoint_executor.shutdown(wait=True)
         self.summary_writer.export_scalars_to_json("{}all_scalars.json".format(self.config.summary_dir))
         self.summary_writer.close()
         self.dataloader.finalize()
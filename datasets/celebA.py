@@ -29,7 +29,8 @@ class CelebADataLoader:
                                      batch_size=config.batch_size,
                                      shuffle=True,
                                      num_workers=config.data_loader_workers,
-                                     pin_memory=config.pin_memory)
+                                     pin_memory=config.pin_memory,
+                                     persistent_workers=config.data_loader_workers > 0)
         elif config.data_mode == "numpy":
             raise NotImplementedError("This mode is not implemented YET")
         else:
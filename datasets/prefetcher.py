@@ -0,0 +1,37 @@
+import torch
+
+
+class CUDAPrefetcher:
+    """
+    Wraps a data loader and copies the next batch to the GPU on a side stream,
+    so the host to device transfer of batch N+1 overlaps the compute of batch N.
+    The wrapped loader should use pinned memory for the copies to be truly asynchronous.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        batch = self._preload(loader_iter)
+        while batch is not None:
+            # make sure the copy of this batch is done before the compute stream uses it
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self.stream)
+            for tensor in batch:
+                tensor.record_stream(current_stream)
+
+            next_batch = self._preload(loader_iter)
+            yield batch
+            batch = next_batch
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return [tensor.cuda(non_blocking=True) for tensor in batch]
@@ -10,3 +10,13 @@ class BinaryCrossEntropy(nn.Module):
     def forward(self, logits, labels):
         loss = self.loss(logits, labels)
         return loss
+
+
+class BinaryCrossEntropyWithLogits(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.loss = nn.BCEWithLogitsLoss()
+
+    def forward(self, logits, labels):
+        loss = self.loss(logits, labels)
+        return loss
@@ -29,10 +29,9 @@ class Discriminator(nn.Module):
         self.conv4 = nn.Conv2d(in_channels=self.config.num_filt_d*4, out_channels=self.config.num_filt_d*8, kernel_size=4, stride=2, padding=1, bias=False)
         self.batch_norm3 = nn.BatchNorm2d(self.config.num_filt_d*8)
 
+        # no final sigmoid, D returns logits which go to the fused sigmoid + BCE loss
         self.conv5 = nn.Conv2d(in_channels=self.config.num_filt_d*8, out_channels=1, kernel_size=4, stride=1, padding=0, bias=False)
 
-        self.out = nn.Sigmoid()
-
         self.apply(weights_init)
 
     def forward(self, x):
@@ -52,7 +51,6 @@ class Discriminator(nn.Module):
         out =  self.relu(out)
 
         out = self.conv5(out)
-        out = self.out(out)
 
         return out.view(-1, 1).squeeze(1)
 
@@ -63,7 +61,7 @@ netD testing
 def main():
     config = json.load(open('../../configs/dcgan_exp_0.json'))
     config = edict(config)
-    inp  = torch.autograd.Variable(torch.randn(config.batch_size, config.input_channels, config.image_size, config.image_size))
+    inp  = torch.randn(config.batch_size, config.input_channels, config.image_size, config.image_size)
     print (inp.shape)
     netD = Discriminator(config)
     out = netD(inp)
@@ -3,8 +3,12 @@ DCGAN generator model
 based on the paper: https://arxiv.org/pdf/1511.06434.pdf
 date: 30 April 2018
 """
+import math
+from contextlib import contextmanager, nullcontext
+
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 import json
 from easydict import EasyDict as edict
@@ -33,30 +37,50 @@ class Generator(nn.Module):
 
         self.out = nn.Tanh()
 
+        # the layers in order (a plain list so state_dict keys are unchanged), forward runs through them
+        self.layers = [self.deconv1, self.batch_norm1, self.relu,
+                       self.deconv2, self.batch_norm2, self.relu,
+                       self.deconv3, self.batch_norm3, self.relu,
+                       self.deconv4, self.batch_norm4, self.relu,
+                       self.deconv5, self.out]
+
         self.apply(weights_init)
 
     def forward(self, x):
-        out = self.deconv1(x)
-        out = self.batch_norm1(out)
-        out = self.relu(out)
-
-        out = self.deconv2(out)
-        out = self.batch_norm2(out)
-        out =  self.relu(out)
-
-        out = self.deconv3(out)
-        out = self.batch_norm3(out)
-        out =  self.relu(out)
-
-        out = self.deconv4(out)
-        out = self.batch_norm4(out)
-        out =  self.relu(out)
-
-        out = self.deconv5(out)
+        if self.config.g_checkpoint and self.training and torch.is_grad_enabled():
+            # keep only the activations at the boundaries of sqrt(n) segments and recompute the rest in backward,
+            # the last segment runs normally since its backward comes first
+            segment_size = math.ceil(len(self.layers) / int(math.sqrt(len(self.layers))))
+            last_start = (len(self.layers) - 1) // segment_size * segment_size
+            out = x
+            for start in range(0, last_start, segment_size):
+                out = checkpoint(self.run_layers, out, start, start + segment_size, use_reentrant=False,
+                                 preserve_rng_state=False, context_fn=self.checkpoint_contexts)
+            return self.run_layers(out, last_start, len(self.layers))
+
+        return self.run_layers(x, 0, len(self.layers))
+
+    def run_layers(self, x, start, end):
+        out = x
+        for layer in self.layers[start:end]:
+            out = layer(out)
+        return out
 
-        out = self.out(out)
+    def checkpoint_contexts(self):
+        # the recomputation in backward must not update the BatchNorm running stats a second time
+        return nullcontext(), self.frozen_batch_norm_stats()
 
-        return out
+    @contextmanager
+    def frozen_batch_norm_stats(self):
+        batch_norms = [layer for layer in self.layers if isinstance(layer, nn.BatchNorm2d)]
+        for batch_norm in batch_norms:
+            # still normalizes with the batch stats in train mode, but leaves the running stats untouched
+            batch_norm.track_running_stats = False
+        try:
+            yield
+        finally:
+            for batch_norm in batch_norms:
+                batch_norm.track_running_stats = True
 
 
 """
@@ -65,7 +89,7 @@ netG testing
 def main():
     config = json.load(open('../../configs/dcgan_exp_0.json'))
     config = edict(config)
-    inp  = torch.autograd.Variable(torch.randn(config.batch_size, config.g_input_size, 1, 1))
+    inp  = torch.randn(config.batch_size, config.g_input_size, 1, 1)
     print (inp.shape)
     netD = Generator(config)
     out = netD(inp)